@@ -1,10 +1,11 @@
-from typing import List, Set, Tuple
+from typing import List, Optional, Set, Tuple
 import numpy as np
 import itertools
 import gurobipy as gp
 from gurobipy import GRB
 import scipy
 import sklearn.linear_model
+from concurrent.futures import ThreadPoolExecutor
 
 class MDP(object):
     """MDP class for use in the following methods which solve the MDP
@@ -41,9 +42,13 @@ class MDP(object):
         self.gamma = gamma  # discount factor
         # transition probability P \in S x S x A
         self.P = P
+        # cumulative transition probabilities P_cdf[s, a, :] \in S x A x S, used for sampling next states
+        self.P_cdf = self.compute_cdf(np.transpose(P, (0, 2, 1)))
         # initial state distribution p_0 \in S
         self.p_0 = p_0
         # reward(S x A) vector itrating by state first
+        # SxA matrices are kept in Fortran order so they are views of these SA vectors and
+        # reshape(..., order="F") between the two never copies
         self.reward = reward
         self.reward_matrix = np.reshape(
             self.reward, (self.num_states, self.num_actions), order="F"
@@ -51,13 +56,19 @@ class MDP(object):
         # features matrix phi \in (SxA)xK where K is the number of features
         self.phi = phi
         self.phi_matrix = phi.reshape(self.num_states, self.num_actions, self.num_features, order='F')
-        # phi_gail \in S X A X (SxA)
-        self.phi_gail = self.compute_phi_gail()
+        # phi_gail[s,a] \in A x (SxA) is the indicator of feature a*(SxA) + s, it is never materialized
+        # see phi_gail_dot and phi_gail_T_dot
+        self.num_gail_features = self.num_actions * self.num_states * self.num_actions
         # Phi matrix for BC \in S x (AxK)
-        # self.phi_SxAK = self.compute_phi_S_AK()
+        self.phi_SxAK = self.compute_phi_S_AK()
 
         # Stacked (I - gamma P_a)
         self.IGammaPAStacked = self.construct_design_matrix()
+        # LPAL model reused across solve_syed calls, see syed_model
+        self.syed_cache = None
+        self.syed_lin_constr = None
+        # Bellman flow model shared by solve_putterman_dual_LP_for_Opt_policy and solve_worst, see flow_model
+        self.flow_cache = None
         # occupancy frequency of an expert's policy u[S x A]
         (u_E, opt_return) = self.solve_putterman_dual_LP_for_Opt_policy()
         self.u_E = u_E  # occupancy frequency of the expert's policy
@@ -71,25 +82,29 @@ class MDP(object):
         self.worst_u = u_worst
         self.worst_return = u_worst_ret
 
-    def compute_phi_gail(self) -> np.ndarray:
-        """Compute phi_gail which is a matrix of size S x A x (SxA)
-            Gail is really picky about the features..."""
-        gail_features = self.num_states * self.num_actions
-        phi_s = np.eye(self.num_states*self.num_actions)[range(self.num_states)]
-        phi_gail = np.zeros((self.num_states, self.num_actions, self.num_actions*gail_features))
-        for action in self.actions:
-            phi_gail[:, action, range(action*gail_features, action*gail_features + gail_features)] = phi_s
-        return phi_gail
+    def phi_gail_dot(self, params: np.ndarray) -> np.ndarray:
+        """Compute phi_gail[s,a] @ params for every state and action
+            Gail is really picky about the features... phi_gail[s,a] is the indicator of feature a*(SxA) + s
+            so this is a gather from params rather than a matrix product
+        params = parameter vector of size A x (SxA)
+        returns a matrix of size SxA"""
+        return params.reshape(self.num_actions, -1)[:, :self.num_states].T
+
+    def phi_gail_T_dot(self, coeffs: np.ndarray) -> np.ndarray:
+        """Compute sum_{s,a} coeffs[s,a] * phi_gail[s,a], the transpose of phi_gail_dot
+        coeffs = matrix of size SxA
+        returns a vector of size A x (SxA)"""
+        vec = np.zeros(self.num_gail_features)
+        vec.reshape(self.num_actions, -1)[:, :self.num_states] = coeffs.T
+        return vec
 
     def compute_phi_S_AK(self) -> np.ndarray:
         """Compute phi_S_AK which is a matrix of size S x (A x K)
         This is used for the behavioral cloning solution"""
-        phi_S_AK = np.zeros((self.num_states, (self.num_actions * self.num_features)))
-        for s in self.states:
-            for a in self.actions:
-                s_prime = self.argmax_next_state(s, a)
-                phi_S_AK[s, a*self.num_features:(a+1)*self.num_features] = self.phi_matrix[s_prime, a, :]
-        return phi_S_AK
+        # most likely next state for every (s,a), see argmax_next_state
+        s_prime = np.argmax(self.P, axis=1)
+        phi_S_AK = self.phi_matrix[s_prime, self.actions[None, :], :]
+        return phi_S_AK.reshape(self.num_states, self.num_actions * self.num_features)
     
     def argmax_next_state(self, state: int, action: int) -> int:
         """Given state and action pair, return the most likely next state based on the MDP dynamics"""
@@ -97,7 +112,8 @@ class MDP(object):
 
     def next_state(self, state: int, action: int) -> int:
         """Given state and action pair, return the next state based on the MDP dynamics"""
-        return np.random.choice(self.states, p=self.P[state, :, action])
+        # same draw as np.random.choice(self.states, p=self.P[state, :, action]) without rebuilding the cdf
+        return int(self.P_cdf[state, action].searchsorted(np.random.rand(), side="right"))
 
     def occupancy_freq_to_policy(self, u, force_deterministic: bool = False) -> np.ndarray:
         """
@@ -107,16 +123,15 @@ class MDP(object):
         S = self.num_states
         A = self.num_actions
         policy = np.zeros((S, A), dtype=float)
+        if force_deterministic:
+            policy[np.arange(S), np.argmax(u, axis=1)] = 1.0
+            return policy
         sum_u_s = np.sum(u, axis=1) # axis=1 means sum over rows
-        for s in range(S):
-            if force_deterministic:
-                policy[s, np.argmax(u[s, :])] = 1.0
-            else:
-                if sum_u_s[s] > 1.0e-10:
-                    policy[s, :] = u[s, :] / max(sum_u_s[s], 1.0e-10)
-                else: # if the sum is 0, then we set it to random
-                    rand_A_vec = np.random.rand(A)
-                    policy[s] = rand_A_vec / np.sum(rand_A_vec)
+        visited = sum_u_s > 1.0e-10
+        policy[visited] = u[visited] / sum_u_s[visited, None]
+        # if the sum is 0, then we set it to random
+        rand_A_mat = np.random.rand(S - np.count_nonzero(visited), A)
+        policy[~visited] = rand_A_mat / np.sum(rand_A_mat, axis=1, keepdims=True)
         return policy
 
     def generate_samples_from_policy(
@@ -126,26 +141,31 @@ class MDP(object):
         policy = policy should be an SxA matrix where each row sums to 1
         """
         D = []  # Dataset of (s, a) pairs
+        policy_cdf = self.compute_cdf(policy)
         cur_state = np.random.choice(self.states, p=self.p_0)
         for _ in range(episodes):
             d = []
-            for _ in range(horizon):
-                action = np.random.choice(self.actions, p=policy[cur_state, :])
+            # one uniform for the action and one for the next state of every step
+            for u_a, u_s in np.random.rand(horizon, 2):
+                action = int(policy_cdf[cur_state].searchsorted(u_a, side="right"))
                 d.append((cur_state, action))
-                cur_state = self.next_state(cur_state, action)
+                cur_state = int(self.P_cdf[cur_state, action].searchsorted(u_s, side="right"))
             D.append(d)
         return D
 
+    def compute_cdf(self, probs: np.ndarray) -> np.ndarray:
+        """Compute the cumulative distributions along the last axis of probs, normalized so the last entry is exactly 1
+        then searchsorted(u, side="right") with u ~ U[0,1) samples an index and never picks a zero probability entry"""
+        cdf = np.cumsum(probs, axis=-1)
+        return cdf / cdf[..., -1:]
+
     def generate_random_policy_return(self) -> Tuple[np.ndarray, float]:
         """Generate the return of a uniformly random policy where pi(a|s) = 1/|A|"""
         # Calculate P_pi for randomized pi
         P_pi = np.sum(self.P, axis=2) / self.num_actions
         r_pi = np.sum(self.reward_matrix, axis=1) / self.num_actions
-        d_pi = np.linalg.inv(np.eye(self.num_states) - self.gamma * P_pi.T) @ self.p_0
-        u_rand = np.zeros((self.num_states, self.num_actions))
-        for s in range(self.num_states):
-            for a in range(self.num_actions):
-                u_rand[s, a] = d_pi[s] * 1/self.num_actions
+        d_pi = self.state_occ_freq_from_P_pi(P_pi)
+        u_rand = np.broadcast_to(d_pi[:, None] / self.num_actions, (self.num_states, self.num_actions)).copy(order="F")
         return u_rand, d_pi @ r_pi
 
     def generate_samples_from_occ_freq(
@@ -168,10 +188,14 @@ class MDP(object):
     def generate_samples_from_action_policy(self, horizon, action_policy, behavior_policy) -> List[Tuple[int, int]]:
         """Generate samples from the given action policy, where transition dynamics are governed by the behavior policy"""
         D: List[Tuple[int, int]] = []
+        action_cdf = self.compute_cdf(action_policy)
+        behavior_cdf = self.compute_cdf(behavior_policy)
         cur_state = np.random.choice(self.states, p=self.p_0)
-        for _ in range(horizon):
-            D.append((cur_state, np.random.choice(self.actions, p=action_policy[cur_state, :])))
-            cur_state = self.next_state(cur_state, np.random.choice(self.actions, p=behavior_policy[cur_state, :]))
+        # one uniform for the recorded action, the behavior action and the next state of every step
+        for u_a, u_b, u_s in np.random.rand(horizon, 3):
+            D.append((cur_state, int(action_cdf[cur_state].searchsorted(u_a, side="right"))))
+            behavior_action = int(behavior_cdf[cur_state].searchsorted(u_b, side="right"))
+            cur_state = int(self.P_cdf[cur_state, behavior_action].searchsorted(u_s, side="right"))
         return D
 
     def generate_off_policy_demonstrations(self, episodes, horizon, behavior_occ_freq) -> List[List[Tuple[int, int]]]:
@@ -222,16 +246,20 @@ class MDP(object):
         policy = self.occupancy_freq_to_policy(occ_freq)
         return self.generate_samples_from_policy(episodes, horizon, policy)
 
-    def construct_design_matrix(self) -> np.ndarray:
+    def construct_design_matrix(self) -> scipy.sparse.csr_matrix:
         """
         Construct the design matrix consisting of (I - gamma P_a) stacked on top of eachother
-        Returns an (SA X S) matrix
+        Returns a sparse (SA X S) matrix, each row only has nonzeros for the reachable next states
         """
-        arrays = []
-        I = np.eye(self.num_states)
-        for action in self.actions:
-            arrays.append((I - self.gamma * self.P[:,:,action]))
-        return np.vstack(arrays)
+        S = self.num_states
+        SA = self.num_states * self.num_actions
+        # row a*S + s holds e_s - gamma P[s,:,a], built straight from the nonzeros of P
+        s, s_prime, a = np.nonzero(self.P)
+        rows = np.concatenate([a * S + s, np.arange(SA)])
+        cols = np.concatenate([s_prime, np.tile(self.states, self.num_actions)])
+        vals = np.concatenate([-self.gamma * self.P[s, s_prime, a], np.ones(SA)])
+        # duplicate (row, col) entries, i.e. the diagonal of self loops, are summed
+        return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(SA, S))
 
     def solve_putterman_dual_LP_for_Opt_policy(self) -> Tuple[np.ndarray, float]:
         """This method solves the problem of Bellman Flow Constraint. This
@@ -242,21 +270,12 @@ class MDP(object):
             ndarray: The optimal policy
             float: optimal return
         """
-        method = "Dual_LP"
         a = self.num_actions
         s = self.num_states
-        p_0 = self.p_0
-        gamma = self.gamma
         r = self.reward
-        W = self.IGammaPAStacked
 
-        # Model
-        model = gp.Model(method)
-        model.Params.OutputFlag = 0
-        # Variables
-        u = model.addMVar(shape=(s * a), lb=0.0)
-        # Constraints
-        model.addMConstr(W.T, u, "==", p_0)
+        # Model and constraints, shared with solve_worst
+        model, u = self.flow_model()
         # setting the objective
         model.setObjective(r @ u, GRB.MAXIMIZE)
         # Solve
@@ -272,27 +291,19 @@ class MDP(object):
             if u_flat[i] < 0:
                 # print(u_flat[i])
                u_flat[i] = 0.0
-        assert np.sum(u_flat) - (1 / (1 - gamma)) < 10**-2
+        assert np.sum(u_flat) - (1 / (1 - self.gamma)) < 10**-2
         return u_flat.reshape((s, a), order="F"), dual_return
 
-    def observed(self, state, D: Set[Tuple]) -> Tuple[bool, int]:
-        for s, a in D:
-            if state == s:
-                return (True, a)
-        return (False, -1)
-
     def construct_constraint_vector(self, D: Set[Tuple]) -> np.ndarray:
         """Constructs the constraint vector for u in Upsilon
         Returns a vector of length num_states * num_actions"""
-        c = np.zeros((self.num_states, self.num_actions))
-        for state in self.states:
-            (observed_state, observed_action) = self.observed(state, D)
-            for action in self.actions:
-                # In order to be in Upsilon, you must observe the state with that action
-                # Consistent with the expert
-                if observed_state and action != observed_action:
-                    # a constraint of 1 means that you shouldnt choose that (s,a) pair
-                    c[state, action] = 1
+        SA = np.fromiter(itertools.chain.from_iterable(D), dtype=np.int64).reshape(-1, 2)
+        c = np.zeros((self.num_states, self.num_actions), order="F")
+        # In order to be in Upsilon, you must observe the state with that action
+        # Consistent with the expert
+        # a constraint of 1 means that you shouldnt choose that (s,a) pair
+        c[SA[:, 0], :] = 1
+        c[SA[:, 0], SA[:, 1]] = 0
         return c.reshape((self.num_states * self.num_actions), order="F")
 
     def solve_chebyshev_center(
@@ -335,18 +346,12 @@ class MDP(object):
             ub=GRB.INFINITY,
         )
 
-        # Add constraints for features
-        for i in range(self.num_features):
-            model.addConstr(
-                (p_0 @ beta[:, i]) <= sigma + (phi[:, i] @ u)
-            )
-            model.addConstr(
-                (p_0 @ betaHat[:, i]) <= sigma - (phi[:, i] @ u)
-            )
-            model.addConstr(phi[:, i] <= alpha[i] * c + (W @ beta[:, i]))
-            model.addConstr(
-                -1 * phi[:, i] <= alphaHat[i] * c + (W @ betaHat[:, i])
-            )
+        # Add constraints for features, one row (or column) per feature
+        c_col = c[:, None]
+        model.addConstr((p_0 @ beta) <= sigma + (u @ phi))
+        model.addConstr((p_0 @ betaHat) <= sigma - (u @ phi))
+        model.addConstr(phi <= c_col * alpha[None, :] + (W @ beta))
+        model.addConstr(-1 * phi <= c_col * alphaHat[None, :] + (W @ betaHat))
 
         # Add constraints for u \in U
         model.addMConstr(W.T, u, "==", p_0)
@@ -366,40 +371,75 @@ class MDP(object):
         # assert np.sum(u_flat) - 1 / (1 - self.gamma) < 10**-2
         return u_flat.reshape((s, a), order="F"), radius, u_flat.T @ self.reward
 
-    def worst_case_regret(self, D, u: np.ndarray) -> float:
+    def solve_inner_maximization(self, method: str, phi_W: np.ndarray, c=None, u_e_hat=None, eps=None, skip=None, num_threads: int = 1) -> np.ndarray:
+        """Solves max_{v in U} v @ phi_W[:, i] for every column i of phi_W, optionally with v in Upsilon (c @ v == 0)
+        and ||v @ phi - u_e_hat @ phi||_inf <= eps. Columns with skip[i] set are not solved and are -inf.
+        The LPs only differ in their objective, so each model is kept (not reset) and every solve warm starts
+        from the previous optimal basis. With num_threads > 1 the columns are split across threads,
+        each with its own gurobi env and model.
+        Returns a vector with the optimal value for every column"""
+        sa = self.num_states * self.num_actions
+        phi = self.phi
+        max_v_r_i = np.full(phi_W.shape[1], -np.inf)
+        columns = np.arange(phi_W.shape[1]) if skip is None else np.flatnonzero(~skip)
+
+        def solve_columns(columns, env=None):
+            with gp.Model("inner maximization", env=env) as model:
+                model.Params.OutputFlag = 0
+                model.Params.LogToConsole = 0
+                # Define model variables
+                v = model.addMVar(shape=(sa), lb=0.0)
+                model.addMConstr(self.IGammaPAStacked.T, v, "==", self.p_0)
+                if c is not None:
+                    model.addConstr(c @ v == 0)
+                if eps is not None:
+                    model.addConstr(v @ phi - u_e_hat @ phi <= eps)
+                    model.addConstr(-v @ phi + u_e_hat @ phi <= eps)
+                model.ModelSense = GRB.MAXIMIZE
+                for i in columns:
+                    v.Obj = phi_W[:, i]
+                    model.optimize()
+                    if model.Status != GRB.Status.OPTIMAL:
+                        raise ValueError(f"{method} DID NOT FIND OPTIMAL SOLUTION")
+                    max_v_r_i[i] = model.objVal
+
+        def solve_columns_in_env(columns):
+            with gp.Env(empty=True) as env:
+                env.setParam("OutputFlag", 0)
+                env.start()
+                solve_columns(columns, env)
+
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                list(pool.map(solve_columns_in_env, np.array_split(columns, num_threads)))
+        else:
+            solve_columns(columns)
+        return max_v_r_i
+
+    def worst_case_regret(self, D, u: np.ndarray, num_threads: int = 1) -> float:
         """Computes the worst case regret of the given occupancy frequency
         that is max pi_e max r (ro(pi_e, r) - ro(pi, r))
+        num_threads = number of threads used to solve the inner maximization LPs
         """
         method = "Worst_Case_Regret"
         k = self.num_features
-        W = self.IGammaPAStacked
         w_i_mat = np.zeros((k*2, k)) # each row is an extreme point of L1 norm ball
         for i in range(0, k):
             w_i_mat[i][i] = 1
             w_i_mat[i+k][i] = -1
+        # column i is the SA reward vector of extreme point i
+        phi_W = self.phi @ w_i_mat.T
         # Solve inner maximization
-        max_v_r_i = np.zeros((k*2))
-        model = gp.Model("inner maximization worst_case_regret")
-        model.Params.OutputFlag = 0
-        # Define model variables
-        v = model.addMVar(shape=(self.num_states * self.num_actions), lb=0.0)
-        model.addMConstr(W.T, v, "==", self.p_0)
         c = self.construct_constraint_vector(set(itertools.chain.from_iterable(D)))
-        model.addConstr(c @ v == 0)
         # dont add linear constraint to worst case expert and reward
-        for i in range(0, k*2):
-            model.reset(0)
-            model.setObjective(v@self.phi@w_i_mat[i], GRB.MAXIMIZE)
-            model.optimize()
-            if model.Status != GRB.Status.OPTIMAL:
-                raise ValueError(f"{method} DID NOT FIND OPTIMAL SOLUTION")
-            max_v_r_i[i] = model.objVal
+        max_v_r_i = self.solve_inner_maximization(method, phi_W, c=c, num_threads=num_threads)
         # compute regret
-        return np.max(max_v_r_i - u@self.phi@w_i_mat.T)
+        return np.max(max_v_r_i - u@phi_W)
 
-    def solve_cheb_part_2(self, D: List[List[Tuple[int, int]]], add_lin_constr: bool, add_linf_constr: bool, passed_eps = None, prune = False) -> Tuple[float, np.ndarray, float, float]:
+    def solve_cheb_part_2(self, D: List[List[Tuple[int, int]]], add_lin_constr: bool, add_linf_constr: bool, passed_eps = None, prune = False, num_threads: int = 1) -> Tuple[float, np.ndarray, float, float]:
         """Solves the chebyshev center problem to find the optimal occupancy_freq, this version first solves 
         an inner maximization problem, then an outer minimization problem
+        num_threads = number of threads used to solve the inner maximization LPs
         Returns eps used for constraints, SA matrix u in U, the chebyshev radius, and the optimal return"""
         method = "Chebyshev_part_2"
         s = self.num_states
@@ -413,7 +453,6 @@ class MDP(object):
         W = self.IGammaPAStacked
         u_e_hat = self.u_hat_all(D).reshape((sa), order="F")
         sampled_points = k*2
-        threshold = -np.inf
         if prune:
             sampled_points = 100
             # Generate the sample points
@@ -423,40 +462,32 @@ class MDP(object):
                 while np.linalg.norm(w, ord=1) > 1:
                     w = np.abs(np.random.rand(k) * 2 - 1)
                 w_i_mat[i] = w / np.linalg.norm(w, ord=1)
-            threshold = np.quantile(u_e_hat @ phi @ w_i_mat.T, 0.9)
         else:
             w_i_mat = np.zeros((k*2, k))
             for i in range(0, k):
                 w_i_mat[i][i] = 1
                 w_i_mat[i+k][i] = -1
+        # column i is the SA reward vector of extreme point i
+        phi_W = phi @ w_i_mat.T
+        pruned = None
+        if prune: # prune the extreme points that dont do well with u_e_hat
+            u_e_hat_returns = u_e_hat @ phi_W
+            threshold = np.quantile(u_e_hat_returns, 0.9)
+            pruned = u_e_hat_returns < threshold
 
-        # solve inner maximization problem
-        max_v_r_i = np.zeros((sampled_points))
-        model = gp.Model("inner maximization")
-        model.Params.OutputFlag = 0
-        model.Params.LogToConsole = 0
-        # Define model variables
-        v = model.addMVar(shape=(sa), lb=0.0)
-        model.addMConstr(W.T, v, "==", p_0)
-        if add_lin_constr:
-            model.addConstr(c @ v == 0)
         # eps = 5000
         # Use the true epsilon if passsed no epsilon
-        eps = passed_eps if passed_eps else (np.linalg.norm(((self.u_E).reshape((sa), order="F") - self.u_hat_all(D).reshape((sa), order="F"))@phi, ord=np.inf) + 1)
-        if add_linf_constr:
-            model.addConstr(v @ phi - u_e_hat @ phi <= eps)
-            model.addConstr(-v @ phi + u_e_hat @ phi <= eps)
-        for i in range(0, sampled_points): # for each extreme point of R
-            model.reset(0)
-            if prune: # prune the extreme points that dont do well with u_e_hat
-                if (u_e_hat @ phi @ w_i_mat[i]) < threshold:
-                    max_v_r_i[i] = -np.inf
-                    continue
-            model.setObjective(v@phi@w_i_mat[i], GRB.MAXIMIZE)
-            model.optimize()
-            if model.Status != GRB.Status.OPTIMAL:
-                raise ValueError(f"{method} DID NOT FIND OPTIMAL SOLUTION")
-            max_v_r_i[i] = model.objVal
+        eps = passed_eps if passed_eps else (np.linalg.norm((self.u_E_flat - u_e_hat)@phi, ord=np.inf) + 1)
+        # solve inner maximization problem for each extreme point of R
+        max_v_r_i = self.solve_inner_maximization(
+            method,
+            phi_W,
+            c=c if add_lin_constr else None,
+            u_e_hat=u_e_hat,
+            eps=eps if add_linf_constr else None,
+            skip=pruned,
+            num_threads=num_threads,
+        )
         # solve outer minimization problem
         model = gp.Model("outer minimization")
         model.Params.OutputFlag = 0
@@ -464,7 +495,7 @@ class MDP(object):
         # Define model Variables
         sigma = model.addVar(lb=0.0, obj=1.0)
         u = model.addMVar(shape=(sa), lb=0.0)
-        model.addConstr(-u@phi@w_i_mat.T + max_v_r_i <= sigma)
+        model.addConstr(-u@phi_W + max_v_r_i <= sigma)
         model.addMConstr(W.T, u, "==", p_0)
         model.addConstr(c @ u == 0) # INFO: CONSTRAINT U TO BE IN UPSILON 
         model.setObjective(sigma, GRB.MINIMIZE)
@@ -495,29 +526,22 @@ class MDP(object):
         method = "Syed LPAL"
         s = self.num_states
         a = self.num_actions
-        p_0 = self.p_0
-        phi = self.phi
-        W = self.IGammaPAStacked
         # Using the experts sample trajectories D, compute an epsilon-good estimate of V
         V_hat = self.compute_V_hat(D, u_e_hat)
-        # Solve the LPAL formulation
-        model = gp.Model(method)
-        model.Params.OutputFlag = 0
-
-        u = model.addMVar(shape=(self.num_states * self.num_actions), name="u", lb=0.0)
-        B = model.addVar(name="B", lb=0.0)
-        # model.addConstr(B <= (u@phi) - V_hat)
-        model.addConstr(B >= (u@phi) - V_hat)
-        model.addConstr(B >= (-1 *(u@phi)) + V_hat)
-        model.addMConstr(W.T, u, "==", p_0)
+        # Solve the LPAL formulation, only V_hat and the Upsilon constraint depend on D
+        model, u, upper, lower = self.syed_model()
+        upper.RHS = V_hat
+        lower.RHS = -V_hat
+        if self.syed_lin_constr is not None:
+            model.remove(self.syed_lin_constr)
+            self.syed_lin_constr = None
         if add_lin_constr:
             c = self.construct_constraint_vector(set(itertools.chain.from_iterable(D)))
-            model.addConstr(c @ u == 0)
+            self.syed_lin_constr = model.addConstr(c @ u == 0)
 
         # model.write("./" + method + ".lp") # write the model to a file, for debugging
-        model.setObjective(B, GRB.MINIMIZE)
-
         # Solve
+        model.reset(0)
         model.optimize()
         if model.Status != GRB.Status.OPTIMAL:
             raise ValueError(f"{method} DID NOT FIND OPTIMAL SOLUTION")
@@ -528,107 +552,201 @@ class MDP(object):
         # assert np.sum(u_flat) - 1 / (1 - self.gamma) < 10**-2
         return u_flat.reshape((s, a), order="F"), radius, u_flat @ self.reward
 
+    def syed_model(self) -> Tuple[gp.Model, gp.MVar, gp.MConstr, gp.MConstr]:
+        """Build the LPAL model of solve_syed once and cache it, later calls only update
+        the right hand side of the V_hat constraints instead of rebuilding the model
+        solve_syed resets the model before solving, a warm start from the previous basis can stop at another
+        optimal u (the LP often has many) and would make the returned u depend on the earlier calls
+        Returns the model, u, and the constraints u@phi - B <= V_hat and -u@phi - B <= -V_hat"""
+        if self.syed_cache is None:
+            phi = self.phi
+            model = gp.Model("Syed LPAL")
+            model.Params.OutputFlag = 0
+
+            u = model.addMVar(shape=(self.num_states * self.num_actions), name="u", lb=0.0)
+            B = model.addVar(name="B", lb=0.0)
+            # model.addConstr(B <= (u@phi) - V_hat)
+            upper = model.addConstr((u@phi) - B <= np.zeros(self.num_features))
+            lower = model.addConstr((-1 *(u@phi)) - B <= np.zeros(self.num_features))
+            model.addMConstr(self.IGammaPAStacked.T, u, "==", self.p_0)
+            model.setObjective(B, GRB.MINIMIZE)
+            self.syed_cache = (model, u, upper, lower)
+        return self.syed_cache
+
+    def flow_model(self) -> Tuple[gp.Model, gp.MVar]:
+        """Build the Bellman flow model W^T u = p_0, u >= 0 once and cache it, the optimal and the
+        worst-case occupancy frequency only differ in the objective, so later solves start from the previous basis
+        Returns the model and u"""
+        if self.flow_cache is None:
+            model = gp.Model("Bellman flow")
+            model.Params.OutputFlag = 0
+            # dual simplex, the flow constraints are sparse and a vertex solution is wanted
+            model.Params.Method = 1
+            u = model.addMVar(shape=(self.num_states * self.num_actions), lb=0.0)
+            model.addMConstr(self.IGammaPAStacked.T, u, "==", self.p_0)
+            self.flow_cache = (model, u)
+        return self.flow_cache
+
+    def __getstate__(self):
+        """Gurobi models cannot be pickled (e.g. by the multiprocessing pool), so drop the cached ones"""
+        state = self.__dict__.copy()
+        state["syed_cache"] = None
+        state["syed_lin_constr"] = None
+        state["flow_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled MDP, the cached gurobi models are rebuilt on first use
+        MDPs pickled by older versions (e.g. envs/*.pkl of gen_datasets.py) lack the derived
+        attributes added since, so rebuild them from P and phi and drop the dense phi_gail"""
+        self.__dict__.update(state)
+        self.__dict__.pop("phi_gail", None)
+        if "P_cdf" not in state:
+            self.P_cdf = self.compute_cdf(np.transpose(self.P, (0, 2, 1)))
+        if "num_gail_features" not in state:
+            self.num_gail_features = self.num_actions * self.num_states * self.num_actions
+        if "phi_SxAK" not in state:
+            self.phi_SxAK = self.compute_phi_S_AK()
+        self.syed_cache = None
+        self.syed_lin_constr = None
+        self.flow_cache = None
+
     def sigmoid_policy(self, theta: np.ndarray, state: int) -> np.ndarray:
         """Compute the sigmoid policy for a given state and parameter vector theta
         theta = parameter vector of size K
         returns a vector of size A"""
-        return scipy.special.softmax(self.phi_gail[state,:] @ theta)
+        return scipy.special.softmax(self.phi_gail_dot(theta)[state])
+
+    def sigmoid_policy_matrix(self, theta: np.ndarray) -> np.ndarray:
+        """Compute the sigmoid policy for every state at once, row s equals sigmoid_policy(theta, s)
+        theta = parameter vector of size K
+        returns a matrix of size SxA"""
+        return scipy.special.softmax(self.phi_gail_dot(theta), axis=1)
 
     def grad_log_policy(self, theta: np.ndarray, state: int, action: int) -> np.ndarray:
         """Compute the gradient of the log policy for a given state, action, and parameter vector theta
         theta = parameter vector of size K
         returns a vector of size K"""
-        return self.phi_gail[state,action] - self.phi_gail[state,:].T @ self.sigmoid_policy(theta, state)
+        coeffs = np.zeros((self.num_states, self.num_actions))
+        coeffs[state] = -self.sigmoid_policy(theta, state)
+        coeffs[state, action] += 1
+        return self.phi_gail_T_dot(coeffs)
+
+    def grad_log_policy_sum(self, theta: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Compute the sum of weights[s,a] * grad_log_policy(theta, s, a) over all states and actions
+        theta = parameter vector of size K, weights = matrix of size SxA
+        returns a vector of size K"""
+        # grad_log_policy(s,a) = phi_gail[s,a] - pi(s) @ phi_gail[s], so the whole sum is a single
+        # phi_gail product with the S x A coefficients below
+        pi = self.sigmoid_policy_matrix(theta)
+        return self.phi_gail_T_dot(weights - np.sum(weights, axis=1, keepdims=True) * pi)
     
-    def occ_freq_from_P_pi(self, P_pi: np.ndarray, pi) -> np.ndarray:
-        """Compute the matrix U
-        given a matrix P_pi of size SxS
-        and a function pi that maps states to a simplex over actions
-        returns a matrix of size SxA
+    def occ_freq_from_policy(self, pi_mat: np.ndarray) -> np.ndarray:
+        """Compute the occupancy frequency of a policy
+        given a policy matrix pi_mat of size SxA where each row sums to 1
+        returns a matrix of size SxA"""
+        dtheta = self.state_occ_freq_from_P_pi(self.P_pi_from_matrix(pi_mat))
+        return np.multiply(pi_mat, dtheta[:, None], order="F")
+
+    def state_occ_freq_from_P_pi(self, P_pi: np.ndarray) -> np.ndarray:
+        """Compute the state occupancy frequency d = (I - gamma P_pi^T)^-1 p_0
+        given a matrix P_pi of size SxS, solved with one LU factorization instead of an explicit inverse
+        returns a vector of size S
         """
-        u = np.zeros((self.num_states, self.num_actions))
-        dtheta = np.linalg.inv(np.eye(self.num_states) - self.gamma * P_pi.T) @ self.p_0
-        for s in self.states:
-            u[s,:] = pi(s) * dtheta[s]
-        return u
+        return scipy.linalg.solve(np.eye(self.num_states) - self.gamma * P_pi.T, self.p_0)
 
-    def P_pi(self, pi) -> np.ndarray:
+    def P_pi_from_matrix(self, pi_mat: np.ndarray) -> np.ndarray:
         """Compute the matrix P_pi
-        given a function pi that maps states to a simplex over actions
+        given a policy matrix pi_mat of size SxA where each row sums to 1
         returns a matrix of size SxS"""
-        Ptheta = np.zeros((self.num_states, self.num_states))
-        for s in self.states:
-            for s_prime in self.states:
-                Ptheta[s,s_prime] = pi(s) @ self.P[s,s_prime,:]
-        return Ptheta
+        return np.einsum('sa,sna->sn', pi_mat, self.P)
+
+    def return_from_occ_freq(self, u: np.ndarray) -> float:
+        """Compute the return of an occupancy frequency u of size SxA
+        u is kept in Fortran order like reward_matrix, so the reshape to an SA vector is a view and not a copy
+        returns a float"""
+        return u.reshape(self.num_states * self.num_actions, order="F") @ self.reward
 
     def u_theta_matrix(self, theta: np.ndarray) -> np.ndarray:
         """Compute the matrix U_theta
         theta = parameter vector of size K
         returns a matrix of size SxA"""
-        pi = lambda s: self.sigmoid_policy(theta, s)
-        Ptheta = self.P_pi(pi)
-        return self.occ_freq_from_P_pi(Ptheta, pi)
+        return self.occ_freq_from_policy(self.sigmoid_policy_matrix(theta))
     
     def generate_samples_from_sigmoid_policy(self, theta: np.ndarray, episodes: int, horizon: int) -> List[List[Tuple[int, int]]]:
         """Generate samples from the sigmoid policy
         theta = parameter vector of size K
         returns a list of episodes, each of length horizon"""
         D: List[List[Tuple[int, int]]] = []
+        policy_cdf = self.compute_cdf(self.sigmoid_policy_matrix(theta))
         for _ in range(0, episodes):
             d = []
             cur_state = np.random.choice(self.states, p=self.p_0)
-            for _ in range(0, horizon):
-                action = np.random.choice(self.actions, p=self.sigmoid_policy(theta, cur_state))
+            # one uniform for the action and one for the next state of every step
+            for u_a, u_s in np.random.rand(horizon, 2):
+                action = int(policy_cdf[cur_state].searchsorted(u_a, side="right"))
                 d.append((cur_state, action))
-                cur_state = self.next_state(cur_state, action)
+                cur_state = int(self.P_cdf[cur_state, action].searchsorted(u_s, side="right"))
             D.append(d)
         return D
 
-    def u_hat_all(self, D:List[List[Tuple[int,int]]]) -> np.ndarray:
+    def u_hat_all(self, D:List[List[Tuple[int,int]]], flat: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None) -> np.ndarray:
         """Compute the empirical occupancy frequency of a given state-action pair
+        flat = flatten_trajectories(D) if the caller already has it
         returns a matrix of all occupancy_freq (SxA)"""
-        u_hat = np.zeros((self.num_states, self.num_actions))
-        for d in D:
-            for t, (s,a) in enumerate(d):
-                u_hat[s,a] += self.gamma**t
-        return u_hat / len(D)
+        states, actions, steps = self.flatten_trajectories(D) if flat is None else flat
+        # index (s,a) by state first so the result is a view of the SA vector layout used everywhere else
+        u_hat_flat = np.bincount(
+            actions * self.num_states + states,
+            weights=self.gamma ** steps,
+            minlength=self.num_states * self.num_actions,
+        ) / len(D)
+        return u_hat_flat.reshape((self.num_states, self.num_actions), order="F")
+
+    def sa_counts(self, D: List[List[Tuple[int,int]]], flat: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None) -> np.ndarray:
+        """Count how many times each state-action pair appears in D
+        flat = flatten_trajectories(D) if the caller already has it
+        returns a matrix of counts (SxA)"""
+        states, actions, _ = self.flatten_trajectories(D) if flat is None else flat
+        counts = np.bincount(actions * self.num_states + states, minlength=self.num_states * self.num_actions)
+        return counts.reshape((self.num_states, self.num_actions), order="F")
+
+    def flatten_trajectories(self, D: List[List[Tuple[int, int]]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Flatten a list of trajectories into int arrays of states, actions and the time step of each sample
+        returns three vectors of length equal to the total number of (s,a) pairs in D"""
+        lengths = [len(d) for d in D]
+        SA = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(D)), dtype=np.int64)
+        SA = SA.reshape(-1, 2)
+        steps = np.concatenate([np.arange(n) for n in lengths]) if lengths else np.zeros(0, dtype=np.int64)
+        return SA[:, 0], SA[:, 1], steps
 
     def D_w(self, state: int, action: int, w: np.ndarray) -> float:
         """Compute the sigmoid function for the current state, action
             returns a float"""
         # return 1 / (1 + np.exp(-1 * self.phi_gail[state,action] @ w))
-        return scipy.special.expit(self.phi_gail[state,action] @ w)
+        return scipy.special.expit(self.phi_gail_dot(w)[state,action])
 
     def Q(self, w:np.ndarray, u_theta:np.ndarray, D:List[List[Tuple[int,int]]]) -> float:
         """Compute the Q value for a given parameter vector w and dataset D
         returns a float"""
-        count = 0
-        for d in D:
-            for (s,a) in d:
-                count += u_theta[s,a] * scipy.special.expit(self.phi_gail[s,a] @ w)
-        return count / len(D)
+        D_w_all = scipy.special.expit(self.phi_gail_dot(w)) # S x A
+        return np.sum(self.sa_counts(D) * u_theta * D_w_all) / len(D)
 
     def Q_log(self, theta:np.ndarray, D:List[List[Tuple[int,int]]]) -> float:
         """Compute the Q value for a given parameter vector theta and dataset d
         returns a float"""
-        count = 0
-        for d in D:
-            for (s,a) in d:
-                count -= np.log(self.sigmoid_policy(theta, s)[a])
-        return count / len(D)
+        log_pi = scipy.special.log_softmax(self.phi_gail_dot(theta), axis=1) # S x A
+        return -np.sum(self.sa_counts(D) * log_pi) / len(D)
 
     def grad_H(self, theta: np.ndarray, u_hat: np.ndarray, D: List[List[Tuple[int,int]]]) -> np.ndarray:
         """Compute the H value for a given parameter vector theta
         returns a float"""
-        gail_features = self.num_states * self.num_actions
-        grad_h = np.zeros(self.num_actions*gail_features)
-        Q = self.Q_log(theta, D)
-        for d in D:
-            for (s,a) in d:
-                q = u_hat[s,a] * (Q - np.log(self.sigmoid_policy(theta, s)[a]))
-                grad_h += u_hat[s,a] * q * self.grad_log_policy(theta, s, a)
-        return grad_h
+        counts = self.sa_counts(D)
+        log_pi = scipy.special.log_softmax(self.phi_gail_dot(theta), axis=1) # S x A
+        Q = -np.sum(counts * log_pi) / len(D)
+        # every sample of (s,a) adds u_hat * q * grad_log_policy(s,a) with q = u_hat * (Q - log pi(a|s))
+        weights = counts * u_hat**2 * (Q - log_pi)
+        return self.grad_log_policy_sum(theta, weights)
 
     def obj(self, theta: np.ndarray) -> float:
         """Compute the objective function for a given parameter vector theta
@@ -644,118 +762,90 @@ class MDP(object):
         theta : vector of a parameterized policy
         returns a float"""
         utheta = self.u_theta_matrix(theta) # Solves for the occupancy frequency from a linear system of eqs
-        ret = 0.0
-        for s in self.states:
-            for a in self.actions:
-                ret += utheta[s,a] * self.reward_matrix[s,a]
-        return ret
+        return float(self.return_from_occ_freq(utheta))
 
     def solve_GAIL(self, D_e: List[List[Tuple[int, int]]], episodes: int, horizon: int) -> tuple[float, np.ndarray]:
         """Solve the GAIL formulation"""
-        phi = self.phi_gail
-        gail_features = self.num_states * self.num_actions
+        gail_features = self.num_gail_features
         learning_rate = 10000
-        E_d_w_expert = np.zeros(self.num_actions*gail_features)
-        E_d_w_theta = np.zeros(self.num_actions*gail_features)
-        grad_theta = np.zeros(self.num_actions*gail_features)
-        # theta_cur = np.random.rand(self.num_actions*gail_features)
-        theta_cur = np.ones(self.num_actions*gail_features)
-        # w_cur = np.random.rand(self.num_actions*gail_features)
-        w_cur = np.ones(self.num_actions*gail_features)
-        u_e = self.u_hat_all(D_e)
+        # theta_cur = np.random.rand(gail_features)
+        theta_cur = np.ones(gail_features)
+        # w_cur = np.random.rand(gail_features)
+        # the discriminator only ever reads phi_gail[s,a] @ w_cur, so keep those S x A values instead of w_cur
+        w_table = np.ones((self.num_states, self.num_actions))
+        # flatten each dataset once for both u_hat_all and sa_counts
+        flat_e = self.flatten_trajectories(D_e)
+        u_e = self.u_hat_all(D_e, flat_e)
         # u_e = self.u_E
+        # Every visit to (s,a) adds the same term to the sums over the trajectories below, so each sum is
+        # an S x A matrix of visit counts times the per (s,a) term, taken as coefficients of phi_gail
+        expert_weights = self.sa_counts(D_e, flat_e) * u_e
         # prior_obj = self.obj(theta_cur)
         # while(prior_obj > 0.001 and iteration < 10):
         for _ in range(20):
             D_theta = self.generate_samples_from_sigmoid_policy(theta_cur, 1, horizon)
-            u_theta = self.u_hat_all(D_theta)
+            flat_theta = self.flatten_trajectories(D_theta)
+            u_theta = self.u_hat_all(D_theta, flat_theta)
             # u_theta = self.u_theta_matrix(theta_cur)
-            # Reset the gradients
-            E_d_w_expert *= 0.0
-            E_d_w_theta *= 0.0
-            grad_theta *= 0.0
-
-            # for s in self.states:
-                # for a in self.actions:
-            for tau_theta in D_theta:
-                for (s,a) in tau_theta:
-                    E_d_w_theta += u_theta[s,a] * (1 - self.D_w(s,a,w_cur)) * phi[s,a,:]
-            # for s_e in self.states:
-                # for a_e in self.actions:
-            for tau_exp in D_e:
-                for (s_e,a_e) in tau_exp:
-                    E_d_w_expert += u_e[s_e,a_e] * -1 * self.D_w(s_e,a_e,w_cur) * phi[s_e,a_e,:]
-            grad_w = E_d_w_expert + E_d_w_theta
-            w_cur += learning_rate * grad_w
-            Q = self.Q(w_cur, u_theta, D_theta)
-            # for s in self.states:
-                # for a in self.actions:
-            for tau_theta in D_theta:
-                for (s,a) in tau_theta:
-                    u_hat = u_theta[s,a]
-                    q = Q + (u_hat * scipy.special.log_expit(phi[s,a,:] @ w_cur))
-                    grad_log_policy = self.grad_log_policy(theta_cur, s, a)
-                    grad_theta += u_hat * q * grad_log_policy
+            theta_weights = self.sa_counts(D_theta, flat_theta) * u_theta
+
+            D_w_all = scipy.special.expit(w_table) # S x A
+            # E_d_w_theta + E_d_w_expert with E_d_w_theta = theta_weights * (1 - D_w_all)
+            # and E_d_w_expert = expert_weights * -1 * D_w_all, combined into one expression
+            # w_cur += learning_rate * self.phi_gail_T_dot(E_d_w_expert + E_d_w_theta) updates exactly these values
+            w_table += learning_rate * (theta_weights - (theta_weights + expert_weights) * D_w_all)
+            # same as self.Q(w_cur, u_theta, D_theta), reusing the visit counts instead of re-flattening D_theta
+            Q = np.sum(theta_weights * scipy.special.expit(w_table)) / len(D_theta)
+            q = Q + (u_theta * scipy.special.log_expit(w_table))
+            # sum of u_hat * q * grad_log_policy(theta_cur, s, a) over the samples
+            grad_theta = self.grad_log_policy_sum(theta_cur, theta_weights * q)
             # grad_H = self.grad_H(theta_cur, u_theta, D_theta)
             # grad_theta -= 0.30*grad_H
             theta_cur -= learning_rate * grad_theta
             # prior_obj = self.obj(theta_cur)
             # learning_rate *= 0.99
-        return self.verify_theta_return(theta_cur), self.u_theta_matrix(theta_cur)  # This takes a long time to compute
+        u_theta = self.u_theta_matrix(theta_cur)  # This takes a long time to compute, so only solve for it once
+        return self.return_from_occ_freq(u_theta), u_theta
 
     def solve_BC(self, D_e: List[List[Tuple[int,int]]], episodes:int, horizon:int) -> float:
         phi = self.phi_SxAK
-        D_flat = set(itertools.chain.from_iterable(D_e))
         # D_flat = list(itertools.chain.from_iterable(D_e))
-        model = sklearn.linear_model.LogisticRegression(multi_class='multinomial', solver='lbfgs', max_iter=5000)
-        X = np.zeros((len(D_flat), self.num_actions*self.num_features))
-        y = np.zeros(len(D_flat))
-        observed_actions = {0:0, 1:0, 2:0, 3:0}
-        for ind, (s,a) in enumerate(D_flat):
-            X[ind, :] = phi[s,:]
-            y[ind] = a
-            observed_actions[a] = 1
+        model = sklearn.linear_model.LogisticRegression(solver='lbfgs', max_iter=5000)
+        # the distinct (s,a) pairs of D_e, found as distinct flat SA indices
+        states, actions, _ = self.flatten_trajectories(D_e)
+        actions, states = np.divmod(np.unique(actions * self.num_states + states), self.num_states)
+        # gather every row of the training set at once
+        X = phi[states]
+        y = actions
         try:
             model.fit(X, y)
         except ValueError: # This happens when there is only one class in the dataset
             return self.random_return
-        pi_mat = model.predict_proba(phi)
-        # Pad the pi_mat since we may not have all actions in the dataset
-        if sum(observed_actions.values()) < self.num_actions:
-            for a in range(self.num_actions):
-                if not observed_actions[a]:
-                    pi_mat = np.insert(pi_mat, a, 0, axis=1)
-        pi = lambda s: pi_mat[s,:] 
-        u_bc = self.occ_freq_from_P_pi(self.P_pi(pi), pi)
-        return u_bc.reshape(self.num_states*self.num_actions, order="F") @ self.reward
+        # Pad the pi_mat since we may not have all actions in the dataset, predict_proba has
+        # one column per action in model.classes_ and the unobserved actions get probability 0
+        pi_mat = np.zeros((self.num_states, self.num_actions))
+        pi_mat[:, model.classes_] = model.predict_proba(phi)
+        u_bc = self.occ_freq_from_policy(pi_mat)
+        return self.return_from_occ_freq(u_bc)
 
     def solve_naive_BC(self, D_e: List[List[Tuple[int, int]]], episodes: int, horizon: int) -> Tuple[np.ndarray, float]:
         """Solve the occupancy frequency cloning formulation
         returns a float"""
         u_e = self.u_hat_all(D_e)
         pi_mat = self.occupancy_freq_to_policy(u_e)
-        pi = lambda s: pi_mat[s,:]
-        u = self.occ_freq_from_P_pi(self.P_pi(pi), pi)
-        return u, u.reshape(self.num_states*self.num_actions, order="F") @ self.reward
+        u = self.occ_freq_from_policy(pi_mat)
+        return u, self.return_from_occ_freq(u)
 
     def solve_worst(self) -> Tuple[np.ndarray, float]:
         """Solve the worst-case bellman flow problem
         returns a tuple of the worst-case occupancy frequency and the 
         corresponding worst-case return"""
-        method = "Worst"
         a = self.num_actions
         s = self.num_states
-        p_0 = self.p_0
         r = self.reward
-        W = self.IGammaPAStacked
 
-        # Model
-        model = gp.Model(method)
-        model.Params.OutputFlag = 0
-        # Variables
-        u = model.addMVar(shape=(s * a), lb=0.0)
-        # Constraints
-        model.addMConstr(W.T, u, "==", p_0)
+        # Model and constraints, shared with solve_putterman_dual_LP_for_Opt_policy
+        model, u = self.flow_model()
         # setting the objective
         model.setObjective(r @ u, GRB.MINIMIZE)
         # Solve
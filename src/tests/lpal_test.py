@@ -1,6 +1,7 @@
 from gridworld import GridWorld
 from driving_sim import DrivingSim
 import numpy as np
+import pickle
 
 def test_gridworld_true_u_e_hat():
     env = GridWorld(10, 0.99)
@@ -15,3 +16,19 @@ def test_driving_true_u_e_hat():
     D = env.generate_samples_from_policy(1, 100, env.opt_policy)
     (_, _, syed_return) = env.solve_syed(D, 1, 100, env.u_E_flat)
     assert(abs(syed_return - env.opt_return) <= 1e-8)
+
+def test_cached_model_matches_fresh_model():
+    np.random.seed(0)
+    env = GridWorld(6, 0.95)
+    D = env.generate_samples_from_policy(3, 40, env.opt_policy)
+    # the cached model adds the Upsilon constraint and then removes it again
+    cached_lin = env.solve_syed(D, 3, 40, add_lin_constr=True)
+    cached = env.solve_syed(D, 3, 40, add_lin_constr=False)
+    # unpickling drops the cached model, so each of these solves builds a fresh one
+    fresh_lin = pickle.loads(pickle.dumps(env)).solve_syed(D, 3, 40, add_lin_constr=True)
+    fresh = pickle.loads(pickle.dumps(env)).solve_syed(D, 3, 40, add_lin_constr=False)
+    # the LP can have many optimal u, only the optimal value and the feature expectations are unique
+    for (u, radius, ret), (u_f, radius_f, ret_f) in [(cached_lin, fresh_lin), (cached, fresh)]:
+        assert(np.allclose(u.reshape(-1, order="F") @ env.phi, u_f.reshape(-1, order="F") @ env.phi))
+        assert(abs(radius - radius_f) <= 1e-8)
+        assert(abs(ret - ret_f) <= 1e-8)
@@ -0,0 +1,60 @@
+from gridworld import GridWorld
+import numpy as np
+import pickle
+
+
+def test_u_hat_all_ragged_trajectories():
+    env = GridWorld(5, 0.9)
+    D = [[(0, 1), (3, 2), (0, 1)], [(4, 0)]]
+    u_hat = env.u_hat_all(D)
+    expected = np.zeros((env.num_states, env.num_actions))
+    expected[0, 1] = (1 + 0.9**2) / 2
+    expected[3, 2] = 0.9 / 2
+    expected[4, 0] = 1 / 2
+    assert(np.allclose(u_hat, expected))
+
+def test_phi_gail_products_match_dense_features():
+    env = GridWorld(3, 0.9)
+    S, A = env.num_states, env.num_actions
+    phi_gail = np.zeros((S, A, env.num_gail_features))
+    for s in range(S):
+        for a in range(A):
+            phi_gail[s, a, a * S * A + s] = 1
+    params = np.random.randn(env.num_gail_features)
+    coeffs = np.random.randn(S, A)
+    assert(np.allclose(env.phi_gail_dot(params), phi_gail @ params))
+    assert(np.allclose(env.phi_gail_T_dot(coeffs), np.tensordot(coeffs, phi_gail, axes=2)))
+
+def test_grad_log_policy_sum_matches_per_pair_gradients():
+    env = GridWorld(3, 0.9)
+    S, A = env.num_states, env.num_actions
+    theta = np.random.randn(env.num_gail_features)
+    weights = np.random.randn(S, A)
+    expected = sum(weights[s, a] * env.grad_log_policy(theta, s, a) for s in range(S) for a in range(A))
+    assert(np.allclose(env.grad_log_policy_sum(theta, weights), expected))
+
+def test_flatten_trajectories():
+    env = GridWorld(3, 0.9)
+    D = [[(0, 1), (2, 3)], [(1, 0)]]
+    states, actions, steps = env.flatten_trajectories(D)
+    assert(np.array_equal(states, [0, 2, 1]) and np.array_equal(actions, [1, 3, 0]) and np.array_equal(steps, [0, 1, 0]))
+    assert(np.allclose(env.u_hat_all(D, (states, actions, steps)), env.u_hat_all(D)))
+    assert(np.array_equal(env.sa_counts(D, (states, actions, steps)), env.sa_counts(D)))
+
+def test_unpickle_mdp_pickled_before_derived_attributes():
+    np.random.seed(0)
+    env = GridWorld(4, 0.9)
+    state = env.__getstate__()
+    for name in ["P_cdf", "num_gail_features", "phi_SxAK", "syed_cache", "syed_lin_constr", "flow_cache"]:
+        del state[name]
+    state["phi_gail"] = np.zeros((env.num_states, env.num_actions, env.num_gail_features))
+    legacy = GridWorld.__new__(GridWorld)
+    legacy.__setstate__(state)
+    restored = pickle.loads(pickle.dumps(legacy))
+    assert(not hasattr(restored, "phi_gail"))
+    assert(np.array_equal(restored.P_cdf, env.P_cdf))
+    assert(restored.num_gail_features == env.num_gail_features)
+    assert(np.array_equal(restored.phi_SxAK, env.phi_SxAK))
+    D = restored.generate_samples_from_policy(2, 10, restored.opt_policy)
+    assert(np.allclose(restored.u_hat_all(D), env.u_hat_all(D)))
+    assert(abs(restored.solve_syed(D, 2, 10)[1] - env.solve_syed(D, 2, 10)[1]) <= 1e-8)